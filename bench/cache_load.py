@@ -0,0 +1,117 @@
+"""
+How much MongoDB read load the balance / usage cache takes away at a given request rate.
+
+    python -m bench.cache_load --rate 500 --seconds 600 --users 10000
+    python -m bench.cache_load --cache-url redis://localhost:6379/15
+
+Replays a synthetic request mix - GET /balance/, GET /tx/ and PUT /tx/ with Zipf-distributed users - through the real
+read_through / invalidate helpers from src/cache.py, against a counting stand-in for MongoDB.
+Time is simulated, so a 10 minute run at 500 req/s takes a few seconds; with --cache-url it uses wall-clock TTLs.
+"""
+import random
+import asyncio
+import argparse
+import itertools
+
+import src.cache
+from src.cache import MemoryCache, RedisCache, read_through, invalidate
+
+
+
+class FakeMongo:
+    """ Balances and per-thread usage in dicts, counting the reads that would have gone to MongoDB. """
+    def __init__(self):
+        self.balances = {}
+        self.usage = {}
+        self.reads = 0
+
+    async def load_balance(self, username: str):
+        self.reads += 1
+        return self.balances.get(username)
+
+    async def load_usage(self, username: str, thread_id: str):
+        self.reads += 1
+        return self.usage.get((username, thread_id), 0)
+
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+
+def zipf_weights(n: int, s: float) -> list:
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+async def run(args, cache, clock: SimClock) -> dict:
+    src.cache.cache = cache
+    mongo = FakeMongo()
+    rng = random.Random(args.seed)
+
+    users = [f"user{i}" for i in range(args.users)]
+    for username in users:
+        mongo.balances[username] = 10_000
+    cum_weights = list(itertools.accumulate(zipf_weights(args.users, args.zipf)))
+
+    total = int(args.rate * args.seconds)
+    for n in range(total):
+        clock.now = n / args.rate
+        username = rng.choices(users, cum_weights=cum_weights)[0]
+        thread_id = f"thread{rng.randrange(args.threads)}"
+        roll = rng.random()
+
+        if roll < args.writes:
+            # PUT /tx/ - the route reads the user from MongoDB, writes, then invalidates
+            mongo.reads += 1
+            tokens_used = rng.randint(1, 20)
+            mongo.balances[username] -= tokens_used
+            mongo.usage[(username, thread_id)] = mongo.usage.get((username, thread_id), 0) + tokens_used
+            await invalidate("balance", username)
+            await invalidate("usage", f"{username}:{thread_id}")
+
+        elif roll < args.writes + (1 - args.writes) / 2:
+            balance = await read_through("balance", username, lambda: mongo.load_balance(username))
+            assert balance == mongo.balances[username], "stale balance served from cache"
+
+        else:
+            usage = await read_through("usage", f"{username}:{thread_id}", lambda: mongo.load_usage(username, thread_id))
+            assert usage == mongo.usage.get((username, thread_id), 0), "stale usage served from cache"
+
+    return {"requests": total, "mongo_reads": mongo.reads}
+
+
+
+async def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.cache_load")
+    parser.add_argument("--rate", type=float, default=500, help="requests per second")
+    parser.add_argument("--seconds", type=float, default=600)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--threads", type=int, default=5, help="threads per user")
+    parser.add_argument("--zipf", type=float, default=1.1, help="skew of user popularity")
+    parser.add_argument("--writes", type=float, default=0.1, help="fraction of requests that are PUT /tx/")
+    parser.add_argument("--cache-url", default=None, help="benchmark a real Redis instead of the in-memory fake")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    clock = SimClock()
+    baseline = await run(args, None, clock)
+
+    cache = RedisCache(args.cache_url) if args.cache_url else MemoryCache(clock=clock)
+    cached = await run(args, cache, clock)
+    await cache.close()
+
+    seconds = baseline["requests"] / args.rate
+    print(f"{baseline['requests']:,} requests at {args.rate:,.0f} req/s over {args.users:,} users ({args.writes:.0%} writes)")
+    print(f"  without cache: {baseline['mongo_reads']:>10,} MongoDB reads ({baseline['mongo_reads'] / seconds:,.1f}/s)")
+    print(f"  with cache:    {cached['mongo_reads']:>10,} MongoDB reads ({cached['mongo_reads'] / seconds:,.1f}/s)")
+    print(f"  reduction:     {1 - cached['mongo_reads'] / baseline['mongo_reads']:.1%}")
+
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
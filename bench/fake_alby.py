@@ -0,0 +1,66 @@
+"""
+Stand-in for the two Alby endpoints the API calls, for replaying traffic without touching real payments.
+
+    FAKE_ALBY_LATENCY_MS=150 FAKE_ALBY_SETTLE_SECONDS=5 uvicorn bench.fake_alby:app --port 5199
+    ALBY_API_URL=http://localhost:5199 PAYEE_LUD16=replay@localhost sh run.sh
+
+`/lnurl/generate-invoice` hands out real (randomly signed) bolt11 invoices so `bolt11.decode` works as usual, and
+`/verify/<id>` reports each invoice as settled once it is FAKE_ALBY_SETTLE_SECONDS old.
+"""
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+
+import bolt11
+from bolt11 import Bolt11, MilliSatoshi, Tags, TagChar
+from fastapi import FastAPI, Request, HTTPException
+
+
+LATENCY_SECONDS = float(os.getenv("FAKE_ALBY_LATENCY_MS", 150)) / 1000
+SETTLE_SECONDS = float(os.getenv("FAKE_ALBY_SETTLE_SECONDS", 5))
+EXPIRY_SECONDS = 600
+
+# one throwaway key for the whole run - nobody checks the signature, it only has to decode
+NODE_KEY = os.urandom(32).hex()
+
+app = FastAPI()
+
+invoices = {} # id -> (created_at, pr)
+
+
+
+def make_invoice(amount_msat: int, description: str) -> str:
+    tags = Tags()
+    tags.add(TagChar.payment_hash, hashlib.sha256(os.urandom(32)).hexdigest())
+    tags.add(TagChar.payment_secret, os.urandom(32).hex())
+    tags.add(TagChar.description, description)
+    tags.add(TagChar.expire_time, EXPIRY_SECONDS)
+    invoice = Bolt11(currency="bc", date=int(time.time()), tags=tags, amount_msat=MilliSatoshi(amount_msat))
+    return bolt11.encode(invoice, private_key=NODE_KEY)
+
+
+
+@app.get("/lnurl/generate-invoice")
+async def generate_invoice(request: Request, ln: str, amount: int, description: str = ""):
+    await asyncio.sleep(LATENCY_SECONDS)
+
+    invoice_id = uuid.uuid4().hex
+    # signing takes a few ms; keep it off the event loop so the fake isn't the bottleneck
+    pr = await asyncio.to_thread(make_invoice, amount, description)
+    invoices[invoice_id] = (time.time(), pr)
+
+    return {"invoice": {"pr": pr, "verify": f"{str(request.base_url).rstrip('/')}/verify/{invoice_id}"}}
+
+
+@app.get("/verify/{invoice_id}")
+async def verify(invoice_id: str):
+    await asyncio.sleep(LATENCY_SECONDS)
+
+    if invoice_id not in invoices:
+        raise HTTPException(status_code=404, detail="Invoice not found")
+
+    created_at, pr = invoices[invoice_id]
+    settled = time.time() - created_at >= SETTLE_SECONDS
+    return {"status": "OK", "settled": settled, "preimage": None, "pr": pr}
@@ -0,0 +1,204 @@
+"""
+Replays a request capture (REQUEST_CAPTURE_PATH) against a local instance and compares latencies per route.
+
+    # 1. local MongoDB (see README) and the fake Alby server
+    uvicorn bench.fake_alby:app --port 5199
+    # 2. the API, pointed at the fake
+    ALBY_API_URL=http://localhost:5199 PAYEE_LUD16=replay@localhost TENANTS=... uvicorn src.app:app --port 5101
+    # 3. replay at 1x, 4x...
+    python -m bench.replay capture.ndjson --speed 4 --seed-balance 100000 --mongo mongodb://localhost:27017
+
+Requests are sent at their captured offsets divided by --speed. --seed-balance first gives every username in the
+capture that balance (per tenant), so PUT /tx/ isn't answered with 404s. It overwrites balances, so it needs an
+explicit --mongo and refuses anything but a local server.
+
+The report compares the server time recorded in the capture with the server time of the replay (the X-Process-Time
+header set by log_requests), per route. The replayer's own round trip is shown separately - it includes HTTP,
+connection setup and queueing in the replayer. It also shows how late requests were sent; if that is high, the
+replayer itself couldn't keep up.
+"""
+import json
+import time
+import asyncio
+import argparse
+import threading
+from urllib.parse import parse_qs, urlparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from src.capture import read_capture
+from src.config import DEFAULT_TENANT
+from src.database import connect_to_mongo, close_mongo_connection, tenant_database
+
+
+
+sessions = threading.local()
+
+
+def send(target: str, entry: dict) -> tuple:
+    """ Runs in a worker thread. Returns (status, server seconds or None, round trip seconds). """
+    if not hasattr(sessions, "session"):
+        sessions.session = requests.Session()
+
+    headers = dict(entry.get("headers", {}))
+    if entry.get("tenant") and entry["tenant"] != DEFAULT_TENANT:
+        headers["X-Tenant"] = entry["tenant"]
+
+    url = f"{target}{entry['path']}"
+    if entry.get("query"):
+        url = f"{url}?{entry['query']}"
+
+    started = time.perf_counter()
+    response = sessions.session.request(entry["method"], url, data=entry.get("body") or None, headers=headers)
+    round_trip = time.perf_counter() - started
+
+    server = response.headers.get("X-Process-Time")
+    return response.status_code, float(server) / 1000 if server is not None else None, round_trip
+
+
+
+def captured_usernames(entries: list) -> dict:
+    """ tenant -> usernames seen in query strings and JSON bodies """
+    users = defaultdict(set)
+    for entry in entries:
+        tenant = entry.get("tenant") or DEFAULT_TENANT
+        for username in parse_qs(entry.get("query", "")).get("username", []):
+            users[tenant].add(username)
+        if entry.get("body"):
+            try:
+                body = json.loads(entry["body"])
+            except ValueError:
+                continue
+            if isinstance(body, dict) and "username" in body:
+                users[tenant].add(body["username"])
+    return users
+
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+
+def is_local_mongo(url: str) -> bool:
+    """ Only plain mongodb:// URLs whose hosts are all on this machine - SRV records always point elsewhere. """
+    parsed = urlparse(url)
+    if parsed.scheme != "mongodb":
+        return False
+    hosts = parsed.netloc.rsplit("@", 1)[-1].split(",")
+    # unix sockets come percent-encoded, e.g. %2Ftmp%2Fmongodb-27017.sock
+    return all(h.startswith("%2F") or h.rsplit(":", 1)[0].strip("[]") in LOCAL_HOSTS for h in hosts)
+
+
+async def seed_balances(entries: list, balance: int, mongo_url: str):
+    if not mongo_url:
+        raise SystemExit("--seed-balance overwrites balances - pass the local server explicitly with --mongo")
+    if not is_local_mongo(mongo_url):
+        raise SystemExit(f"Refusing to seed balances on {mongo_url} - --seed-balance only writes to a local MongoDB")
+
+    await connect_to_mongo(mongo_url)
+    try:
+        for tenant, usernames in captured_usernames(entries).items():
+            users = tenant_database(tenant).users
+            for username in usernames:
+                await users.update_one({"username": username}, {"$set": {"balance": balance}}, upsert=True)
+            print(f"Seeded {len(usernames):,} users in tenant {tenant} with a balance of {balance:,}")
+    finally:
+        await close_mongo_connection()
+
+
+
+async def replay(entries: list, target: str, speed: float, max_in_flight: int) -> list:
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=max_in_flight)
+    results = []
+
+    t0 = entries[0]["t"]
+    start = time.perf_counter()
+
+    async def fire(entry: dict):
+        due = (entry["t"] - t0) / speed
+        delay = due - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        late = max(0.0, (time.perf_counter() - start) - due)
+
+        try:
+            status, server, round_trip = await loop.run_in_executor(pool, send, target, entry)
+        except requests.RequestException as e:
+            status, server, round_trip = f"error: {type(e).__name__}", None, None
+        results.append({"entry": entry, "status": status, "server": server, "round_trip": round_trip, "late": late})
+
+    await asyncio.gather(*(fire(entry) for entry in entries))
+    pool.shutdown()
+    return results
+
+
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def p50_p95(samples: list) -> str:
+    if not samples:
+        return "-"
+    return f"{percentile(samples, 0.5):.1f} / {percentile(samples, 0.95):.1f}"
+
+
+def report(results: list):
+    routes = defaultdict(list)
+    for result in results:
+        routes[f"{result['entry']['method']} {result['entry']['path']}"].append(result)
+
+    print("p50 / p95 in ms - 'server' is time inside the API, 'round trip' is what the replayer saw")
+    print(f"{'route':<28} {'n':>7} {'captured server':>16} {'replayed server':>16} {'server delta':>16} {'round trip':>16} {'status diff':>12}")
+    for route, rows in sorted(routes.items()):
+        captured = [r["entry"]["ms"] for r in rows]
+        server = [r["server"] * 1000 for r in rows if r["server"] is not None]
+        round_trip = [r["round_trip"] * 1000 for r in rows if r["round_trip"] is not None]
+        mismatched = sum(1 for r in rows if r["status"] != r["entry"]["status"])
+
+        if server:
+            c50, c95 = percentile(captured, 0.5), percentile(captured, 0.95)
+            s50, s95 = percentile(server, 0.5), percentile(server, 0.95)
+            delta = f"{s50 - c50:+.1f} / {s95 - c95:+.1f}"
+        else:
+            delta = "no X-Process-Time"
+
+        print(
+            f"{route:<28} {len(rows):>7} {p50_p95(captured):>16} {p50_p95(server):>16} {delta:>16} "
+            f"{p50_p95(round_trip):>16} {mismatched:>12}"
+        )
+
+    late = [r["late"] * 1000 for r in results]
+    print(f"\nsend lateness: p50 {percentile(late, 0.5):.1f}ms  p99 {percentile(late, 0.99):.1f}ms  max {max(late):.1f}ms")
+
+
+
+async def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.replay")
+    parser.add_argument("capture", help="NDJSON file written with REQUEST_CAPTURE_PATH")
+    parser.add_argument("--target", default="http://localhost:5101")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 = captured pace, 4 = four times faster")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="requests allowed to be outstanding at once")
+    parser.add_argument("--seed-balance", type=int, default=None, help="give every captured username this balance first")
+    parser.add_argument("--mongo", default=None, help="local MongoDB URL to seed, required with --seed-balance")
+    args = parser.parse_args()
+
+    entries = sorted(read_capture(args.capture), key=lambda e: e["t"])
+    if not entries:
+        raise SystemExit("Nothing to replay")
+
+    if args.seed_balance is not None:
+        await seed_balances(entries, args.seed_balance, args.mongo)
+
+    span = entries[-1]["t"] - entries[0]["t"]
+    print(f"Replaying {len(entries):,} requests spanning {span:.1f}s at {args.speed}x against {args.target}\n")
+
+    results = await replay(entries, args.target.rstrip("/"), args.speed, args.max_in_flight)
+    report(results)
+
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+"""
+Does one process serve N tenants at the same latency as one?
+
+    python -m bench.tenants --tenants 1 4 16 --requests 20000 --concurrency 64
+    python -m bench.tenants --handles-only       # no MongoDB needed
+
+Seeds `--users` users into each tenant's database (user_balance_bench<i>), then fires `--requests` balance lookups
+spread evenly over the tenants with `--concurrency` in flight, each resolving its database through get_db() exactly
+like a request would, and reports p50 / p99 latency per tenant count. The bench databases are dropped at the end.
+
+--handles-only compares resolving collection handles through the cached registry with the old
+`get_collection` per call, which needs no server.
+"""
+import time
+import random
+import asyncio
+import argparse
+import statistics
+
+from src.database import db, connect_to_mongo, close_mongo_connection, current_tenant, get_db, tenant_database, database_name
+
+
+
+def percentile(samples: list, p: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+
+def bench_handles(tenants: int, lookups: int):
+    names = [f"bench{i}" for i in range(tenants)]
+
+    started = time.perf_counter()
+    for n in range(lookups):
+        current_tenant.set(names[n % tenants])
+        get_db().users
+    registry = (time.perf_counter() - started) / lookups
+
+    started = time.perf_counter()
+    for n in range(lookups):
+        db.client[database_name(names[n % tenants])].get_collection("users")
+    per_call = (time.perf_counter() - started) / lookups
+
+    print(f"collection handle for 1 of {tenants} tenants: registry {registry * 1e6:.2f}us, get_collection per call {per_call * 1e6:.2f}us")
+
+
+
+async def seed(tenants: list, users: int):
+    for name in tenants:
+        handle = tenant_database(name)
+        await handle.users.drop()
+        await handle.users.insert_many([{"username": f"user{i}", "balance": 1000} for i in range(users)])
+        await handle.users.create_index("username")
+
+
+async def bench_requests(tenants: list, users: int, requests: int, concurrency: int) -> list:
+    slots = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def lookup(n: int):
+        async with slots:
+            # each task gets its own copy of the context, like each request does
+            current_tenant.set(tenants[n % len(tenants)])
+            started = time.perf_counter()
+            await get_db().users.find_one({"username": f"user{random.randrange(users)}"})
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(lookup(n) for n in range(requests)))
+    return latencies
+
+
+
+async def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.tenants")
+    parser.add_argument("--tenants", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--users", type=int, default=1000, help="users per tenant")
+    parser.add_argument("--requests", type=int, default=20_000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--handles-only", action="store_true")
+    args = parser.parse_args()
+
+    await connect_to_mongo()
+    try:
+        for count in args.tenants:
+            bench_handles(count, 100_000)
+
+        if args.handles_only:
+            return
+
+        names = [f"bench{i}" for i in range(max(args.tenants))]
+        await seed(names, args.users)
+
+        # warm up the connection pool so the first tenant count isn't paying for it
+        await bench_requests(names[:1], args.users, args.concurrency * 10, args.concurrency)
+
+        for count in args.tenants:
+            latencies = await bench_requests(names[:count], args.users, args.requests, args.concurrency)
+            print(
+                f"{count:>3} tenants: p50 {percentile(latencies, 0.5) * 1000:.2f}ms  "
+                f"p99 {percentile(latencies, 0.99) * 1000:.2f}ms  "
+                f"mean {statistics.mean(latencies) * 1000:.2f}ms"
+            )
+
+        for name in names:
+            await db.client.drop_database(database_name(name))
+    finally:
+        await close_mongo_connection()
+
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,20 +1,29 @@
+import time
 import dotenv
 dotenv.load_dotenv()
 
 from src.logger import setup_logging, logger
 setup_logging()
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 
-from src.database import connect_to_mongo, close_mongo_connection
+from src.config import DEFAULT_TENANT, TENANTS, TENANT_API_KEYS
+from src.database import connect_to_mongo, close_mongo_connection, current_tenant
+from src.cache import connect_cache, close_cache
+from src.capture import open_capture, close_capture, capture_enabled, capture_request
 from src.routes import user_routes #, admin_routes
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await connect_to_mongo()
+    await connect_cache()
+    open_capture()
     yield
+    close_capture()
+    await close_cache()
     await close_mongo_connection()
 
 app = FastAPI(lifespan=lifespan)
@@ -33,10 +42,46 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def select_tenant(request: Request, call_next):
+    """ Routes the request to a tenant's database - by API key if one is given, otherwise by the X-Tenant header. """
+    api_key = request.headers.get("X-API-Key")
+    if api_key is not None:
+        tenant = TENANT_API_KEYS.get(api_key)
+        if tenant is None:
+            return JSONResponse(status_code=status.HTTP_401_UNAUTHORIZED, content={"detail": "Invalid API key"})
+    else:
+        tenant = request.headers.get("X-Tenant", DEFAULT_TENANT)
+        if tenant != DEFAULT_TENANT and tenant not in TENANTS:
+            return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"detail": "Unknown tenant"})
+
+    current_tenant.set(tenant)
+    request.state.tenant = tenant # for the request capture in log_requests
+    return await call_next(request)
+
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     logger.info(f"Request: {request.method} {request.url}")
-    response = await call_next(request)
+
+    body = await request.body() if capture_enabled() else None
+    started = time.time()
+    timer = time.perf_counter()
+    try:
+        response = await call_next(request)
+    except Exception:
+        elapsed = time.perf_counter() - timer
+        if capture_enabled():
+            capture_request(request, body, 500, started, elapsed)
+        logger.error(f"Response: 500 after {elapsed * 1000:.3f}ms (unhandled exception)")
+        raise
+    elapsed = time.perf_counter() - timer
+
+    # server-side time, so bench/replay.py can compare it with the captured one without network and client overhead
+    response.headers["X-Process-Time"] = f"{elapsed * 1000:.3f}"
+    if capture_enabled():
+        capture_request(request, body, response.status_code, started, elapsed)
+
     logger.info(f"Response: {response.status_code}")
     return response
 
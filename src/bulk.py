@@ -0,0 +1,280 @@
+"""
+Bulk export / import of the `users`, `invoices` and `transactions` collections.
+
+    python -m src.bulk export users users.ndjson
+    python -m src.bulk export invoices invoices.bson --format bson
+    python -m src.bulk import users users.ndjson
+    python -m src.bulk snapshot balances.ndjson
+    python -m src.bulk synth users.ndjson --count 1000000
+
+Everything is streamed with a bounded batch size, so memory stays flat no matter how many documents there are.
+Use `-` as the path to read from stdin / write to stdout.
+"""
+import sys
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime
+
+import dotenv
+import bson
+from bson import json_util
+from pymongo import InsertOne, ReplaceOne
+
+from src.logger import setup_logging, logger
+from src.database import db, connect_to_mongo, close_mongo_connection, tenant_database
+
+
+COLLECTIONS = ["users", "invoices", "transactions"]
+
+# natural key used to upsert each collection, so re-importing the same file is idempotent
+UPSERT_KEYS = {
+    "users": "username",
+    "invoices": "pr",
+    "transactions": "_id",
+}
+
+JSON_OPTIONS = json_util.RELAXED_JSON_OPTIONS
+
+PROGRESS_EVERY = 100_000
+
+
+
+class Throughput:
+    """ Counts documents and logs progress and a final docs/sec figure. """
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.started = time.perf_counter()
+
+    def add(self, n: int = 1):
+        before = self.count
+        self.count += n
+        if self.count // PROGRESS_EVERY > before // PROGRESS_EVERY:
+            logger.info(f"{self.label}: {self.count:,} documents ({self.rate():,.0f} docs/s)")
+
+    def rate(self) -> float:
+        return self.count / max(time.perf_counter() - self.started, 1e-9)
+
+    def done(self):
+        elapsed = time.perf_counter() - self.started
+        logger.info(f"{self.label}: {self.count:,} documents in {elapsed:.2f}s ({self.rate():,.0f} docs/s)")
+
+
+
+def open_output(path: str, fmt: str):
+    if path == "-":
+        if fmt == "bson":
+            return sys.stdout.buffer
+        return sys.stdout
+    return open(path, "wb" if fmt == "bson" else "w", encoding=None if fmt == "bson" else "utf-8")
+
+
+def open_input(path: str, fmt: str):
+    if path == "-":
+        if fmt == "bson":
+            return sys.stdin.buffer
+        return sys.stdin
+    return open(path, "rb" if fmt == "bson" else "r", encoding=None if fmt == "bson" else "utf-8")
+
+
+def close_stream(f):
+    if f not in (sys.stdin, sys.stdin.buffer, sys.stdout, sys.stdout.buffer):
+        f.close()
+
+
+def write_doc(out, doc: dict, fmt: str):
+    if fmt == "bson":
+        out.write(bson.encode(doc))
+    else:
+        out.write(json_util.dumps(doc, json_options=JSON_OPTIONS))
+        out.write("\n")
+
+
+def read_docs(src, fmt: str):
+    if fmt == "bson":
+        yield from bson.decode_file_iter(src)
+        return
+
+    for line in src:
+        line = line.strip()
+        if line:
+            yield json_util.loads(line, json_options=JSON_OPTIONS)
+
+
+def guess_format(path: str, fmt: str) -> str:
+    if fmt:
+        return fmt
+    return "bson" if path.endswith(".bson") else "ndjson"
+
+
+
+async def export_collection(collection: str, path: str, fmt: str, batch_size: int):
+    cursor = db.db.get_collection(collection).find({}, batch_size=batch_size)
+    progress = Throughput(f"export {collection}")
+
+    out = open_output(path, fmt)
+    try:
+        async for doc in cursor:
+            write_doc(out, doc, fmt)
+            progress.add()
+    finally:
+        close_stream(out)
+
+    progress.done()
+
+
+
+def upsert_op(doc: dict, key: str):
+    if key not in doc:
+        return InsertOne(doc)
+
+    if key == "_id":
+        return ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+
+    # the _id from another deployment would clash with an existing document's _id, so let the target keep its own
+    doc.pop("_id", None)
+    return ReplaceOne({key: doc[key]}, doc, upsert=True)
+
+
+async def import_collection(collection: str, path: str, fmt: str, batch_size: int, key: str):
+    target = db.db.get_collection(collection)
+    if key != "_id":
+        await target.create_index(key)
+
+    progress = Throughput(f"import {collection}")
+
+    # keep one bulk_write in flight while the next batch is being parsed; memory is bounded by two batches
+    in_flight = None
+    batch = []
+
+    async def flush(ops):
+        await target.bulk_write(ops, ordered=False)
+        progress.add(len(ops))
+
+    src = open_input(path, fmt)
+    try:
+        for doc in read_docs(src, fmt):
+            batch.append(upsert_op(doc, key))
+            if len(batch) >= batch_size:
+                if in_flight:
+                    await in_flight
+                in_flight = asyncio.create_task(flush(batch))
+                batch = []
+                # let the write get going before we parse the next batch
+                await asyncio.sleep(0)
+
+        if in_flight:
+            await in_flight
+        if batch:
+            await flush(batch)
+    finally:
+        close_stream(src)
+
+    progress.done()
+
+
+
+async def snapshot_balances(path: str, fmt: str, batch_size: int):
+    """
+        Writes `{username, balance}` for every user as of a single point in time, using a snapshot read session.
+
+        NOTE: snapshot reads need a replica set, and the server only keeps snapshot history for
+        `minSnapshotHistoryWindowInSeconds` (5 minutes by default) - raise it for very large exports.
+        The output can be loaded back with `import users`.
+    """
+    logger.info(f"Taking balance snapshot at {datetime.utcnow()} UTC")
+    async with await db.client.start_session(snapshot=True) as session:
+        cursor = db.db.get_collection("users").find(
+            {},
+            projection={"_id": False, "username": True, "balance": True},
+            batch_size=batch_size,
+            session=session,
+        )
+        progress = Throughput("snapshot balances")
+
+        out = open_output(path, fmt)
+        try:
+            async for doc in cursor:
+                write_doc(out, doc, fmt)
+                progress.add()
+        finally:
+            close_stream(out)
+
+        progress.done()
+
+
+
+def synth_users(path: str, fmt: str, count: int):
+    """ Writes `count` synthetic users, e.g. to benchmark `import users` without touching production data. """
+    progress = Throughput("synth users")
+    out = open_output(path, fmt)
+    try:
+        for i in range(count):
+            write_doc(out, {"username": f"user{i:09d}", "balance": random.randint(0, 100_000), "created_at": datetime.utcnow()}, fmt)
+            progress.add()
+    finally:
+        close_stream(out)
+    progress.done()
+
+
+
+def parse_args(argv=None):
+    # shared by every subcommand so they can be given after it, e.g. `import users users.ndjson --batch-size 5000`
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--tenant", default=None, help="work on this tenant's database instead of the default one")
+    common.add_argument("--batch-size", type=int, default=1000, help="documents per cursor batch / bulk_write (default: 1000)")
+    common.add_argument("--format", choices=["ndjson", "bson"], default=None, help="defaults to bson for *.bson paths, ndjson otherwise")
+
+    parser = argparse.ArgumentParser(prog="python -m src.bulk", description="Streaming bulk export/import for PlebChatDB")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", parents=[common], help="stream a collection to a file")
+    export.add_argument("collection", choices=COLLECTIONS)
+    export.add_argument("path")
+
+    import_ = sub.add_parser("import", parents=[common], help="upsert a file into a collection with batched bulk_write")
+    import_.add_argument("collection", choices=COLLECTIONS)
+    import_.add_argument("path")
+    import_.add_argument("--key", default=None, help="field to upsert on (default: username / pr / _id)")
+
+    snapshot = sub.add_parser("snapshot", parents=[common], help="point-in-time export of every user's balance")
+    snapshot.add_argument("path")
+
+    synth = sub.add_parser("synth", parents=[common], help="write synthetic users for benchmarking")
+    synth.add_argument("path")
+    synth.add_argument("--count", type=int, default=1_000_000)
+
+    return parser.parse_args(argv)
+
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    fmt = guess_format(args.path, args.format)
+
+    if args.command == "synth":
+        synth_users(args.path, fmt, args.count)
+        return
+
+    await connect_to_mongo()
+    if args.tenant:
+        db.db = tenant_database(args.tenant).db
+
+    try:
+        if args.command == "export":
+            await export_collection(args.collection, args.path, fmt, args.batch_size)
+        elif args.command == "import":
+            await import_collection(args.collection, args.path, fmt, args.batch_size, args.key or UPSERT_KEYS[args.collection])
+        elif args.command == "snapshot":
+            await snapshot_balances(args.path, fmt, args.batch_size)
+    finally:
+        await close_mongo_connection()
+
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    setup_logging()
+    asyncio.run(main())
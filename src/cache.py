@@ -0,0 +1,145 @@
+import time
+from typing import Awaitable, Callable, Optional
+
+from src.logger import logger
+from src.database import current_tenant
+from src.config import CACHE_URL, CACHE_TTL_SECONDS
+
+
+
+class MemoryCache:
+    """
+        In-process stand-in for Redis, for tests and single-worker setups.
+
+        Only implements the handful of commands the cache helpers below use. `clock` can be swapped for a fake one.
+    """
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.data = {} # key -> (value, expires_at)
+
+    async def get(self, key: str) -> Optional[str]:
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= self.clock():
+            del self.data[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: str, ttl: int):
+        self.data[key] = (str(value), self.clock() + ttl)
+
+    async def incr(self, key: str) -> int:
+        """ Like Redis INCR: the counter never expires. """
+        value = int(await self.get(key) or 0) + 1
+        self.data[key] = (str(value), None)
+        return value
+
+    async def close(self):
+        self.data.clear()
+
+
+
+class RedisCache:
+    """ Cache shared by every worker, backed by Redis (or anything that speaks its protocol). """
+    def __init__(self, url: str):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise NotImplementedError("CACHE_URL points at Redis but the `redis` package is not installed (pip install redis)")
+
+        self.client = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: str, ttl: int):
+        await self.client.set(key, value, ex=ttl)
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(key)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+
+cache = None
+
+
+async def connect_cache():
+    global cache
+    if not CACHE_URL:
+        logger.info("No CACHE_URL set - reading balances and usage straight from MongoDB")
+        return
+
+    if CACHE_URL.startswith("memory://"):
+        cache = MemoryCache()
+    elif CACHE_URL.startswith(("redis://", "rediss://", "unix://")):
+        cache = RedisCache(CACHE_URL)
+    else:
+        raise NotImplementedError(f"Unknown CACHE_URL scheme: {CACHE_URL}")
+
+    logger.info(f"Caching balances and usage in {type(cache).__name__}")
+
+
+async def close_cache():
+    global cache
+    if cache is not None:
+        await cache.close()
+        cache = None
+
+
+
+# Every cached value lives under a versioned key: "<tenant>:<kind>:<id>:<version>". The version counters have no TTL:
+# one that expired and restarted would land on a version number that readers may still have a value parked under.
+# That costs one small integer per user / thread ever written, which is cheap next to the values themselves.
+#
+# Writers never store values, they only bump the version after their MongoDB write has landed. A reader that loaded
+# an old value from MongoDB can then only park it under a version nobody reads any more, and writers that finish in
+# a different order than their MongoDB writes can't leave an older value cached - the next read loads the latest.
+#
+# The cache is optional: every helper logs and carries on if the cache itself fails, so an outage only costs the
+# extra MongoDB reads.
+
+def base_key(kind: str, ident: str) -> str:
+    return f"{current_tenant.get()}:{kind}:{ident}"
+
+
+def version_key(kind: str, ident: str) -> str:
+    return f"v:{base_key(kind, ident)}"
+
+
+async def read_through(kind: str, ident: str, load: Callable[[], Awaitable[Optional[int]]]) -> Optional[int]:
+    """ Returns the cached value, or calls `load()` and caches what it returns. None is never cached. """
+    if cache is None:
+        return await load()
+
+    try:
+        version = await cache.get(version_key(kind, ident)) or 0
+        key = f"{base_key(kind, ident)}:{version}"
+        value = await cache.get(key)
+    except Exception as e:
+        logger.error(f"Cache read failed, falling back to MongoDB: {e}")
+        return await load()
+
+    if value is not None:
+        return int(value)
+
+    value = await load()
+    if value is not None:
+        try:
+            await cache.set(key, value, CACHE_TTL_SECONDS)
+        except Exception as e:
+            logger.error(f"Cache write failed: {e}")
+    return value
+
+
+async def invalidate(kind: str, ident: str):
+    """ Call after the MongoDB write has landed - the next read_through reloads the value. """
+    if cache is None:
+        return
+
+    try:
+        await cache.incr(version_key(kind, ident))
+    except Exception as e:
+        # nothing else we can do; the stale value expires after CACHE_TTL_SECONDS
+        logger.error(f"Cache invalidation of {kind} {ident} failed: {e}")
@@ -0,0 +1,69 @@
+import json
+
+from fastapi import Request
+
+from src.logger import logger
+from src.config import REQUEST_CAPTURE_PATH
+
+
+# Headers worth replaying. API keys are deliberately left out - the resolved tenant is recorded instead.
+CAPTURED_HEADERS = ["content-type"]
+
+capture_file = None
+
+
+
+def open_capture():
+    global capture_file
+    if not REQUEST_CAPTURE_PATH:
+        return
+
+    # line buffered: every request is flushed as one complete line, so a crash or a concurrent reader never sees half
+    capture_file = open(REQUEST_CAPTURE_PATH, "a", encoding="utf-8", buffering=1)
+    logger.info(f"Capturing requests to {REQUEST_CAPTURE_PATH}")
+
+
+def close_capture():
+    global capture_file
+    if capture_file is not None:
+        capture_file.close()
+        capture_file = None
+
+
+def capture_enabled() -> bool:
+    return capture_file is not None
+
+
+
+def capture_request(request: Request, body: bytes, status_code: int, started: float, elapsed: float):
+    """
+        Appends one request as a line of NDJSON:
+        {"t": <unix start time>, "method", "path", "query", "tenant", "headers", "body", "status", "ms": <server time>}
+    """
+    entry = {
+        "t": round(started, 6),
+        "method": request.method,
+        "path": request.url.path,
+        "query": request.url.query,
+        "tenant": getattr(request.state, "tenant", None),
+        "headers": {h: request.headers[h] for h in CAPTURED_HEADERS if h in request.headers},
+        "body": body.decode("utf-8", errors="replace"),
+        "status": status_code,
+        "ms": round(elapsed * 1000, 3),
+    }
+    capture_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+
+
+def read_capture(path: str):
+    """ Yields the captured requests in the order they were written, skipping lines that aren't valid JSON. """
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                # e.g. the last line of a capture whose server was killed mid-write
+                logger.warning(f"Skipping malformed line {number} of {path}: {e}")
@@ -1 +1,31 @@
+import os
+
 TOKENS_PER_SAT = 10
+
+# Per-user, per-route token buckets in front of the routes that reach the payment provider
+RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", 30))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", 10))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory") # "memory" (per worker) or "mongo" (shared across workers)
+
+# Admission control around calls to api.getalby.com
+PROVIDER_MAX_CONCURRENCY = int(os.getenv("PROVIDER_MAX_CONCURRENCY", 8))
+PROVIDER_ACQUIRE_TIMEOUT = float(os.getenv("PROVIDER_ACQUIRE_TIMEOUT", 0.5)) # seconds to wait for a free slot
+PROVIDER_REQUEST_TIMEOUT = float(os.getenv("PROVIDER_REQUEST_TIMEOUT", 10))
+PROVIDER_FAILURE_THRESHOLD = int(os.getenv("PROVIDER_FAILURE_THRESHOLD", 5)) # consecutive failures before the breaker opens
+PROVIDER_RESET_SECONDS = float(os.getenv("PROVIDER_RESET_SECONDS", 30)) # how long the breaker stays open
+
+# Shared cache for balances and per-thread usage: "" (off), "memory://" (per worker, for tests) or "redis://host:6379/0"
+CACHE_URL = os.getenv("CACHE_URL", "")
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 60))
+
+# Multi-tenancy: each chat front-end gets its own database on the shared connection pool.
+# The default tenant keeps using the original `user_balance` database.
+DEFAULT_TENANT = "default"
+TENANTS = [t.strip() for t in os.getenv("TENANTS", "").split(",") if t.strip()] # tenants that may be picked with the X-Tenant header
+TENANT_API_KEYS = dict(pair.strip().split(":", 1) for pair in os.getenv("TENANT_API_KEYS", "").split(",") if pair.strip()) # "key1:tenant1,key2:tenant2" for the X-API-Key header
+
+# Point at a fake Alby server (bench/fake_alby.py) when replaying captured traffic locally
+ALBY_API_URL = os.getenv("ALBY_API_URL", "https://api.getalby.com")
+
+# Append every request (route, body, status, timing) to this NDJSON file, for bench/replay.py
+REQUEST_CAPTURE_PATH = os.getenv("REQUEST_CAPTURE_PATH", "")
@@ -1,26 +1,63 @@
 import os
 # import logging
 # logger = logging.getLogger(__name__)
+from contextvars import ContextVar
+
 from src.logger import logger
+from src.config import DEFAULT_TENANT
 
 from motor.motor_asyncio import AsyncIOMotorClient
 
 
 
+class TenantDatabase:
+    """ One tenant's database, with the collection handles resolved once and reused for every request. """
+    def __init__(self, name: str, database):
+        self.name = name
+        self.db = database
+        self.users = database.get_collection("users")
+        self.invoices = database.get_collection("invoices")
+        self.transactions = database.get_collection("transactions")
+
+
 class Database:
     client: AsyncIOMotorClient = None
-    db = None
+    db = None # the default tenant's database - used by the CLI tools
+    tenants: dict = None # tenant name -> TenantDatabase, all sharing `client` and its connection pool
 
 
 db = Database()
 
+# set per request by the tenant middleware in src/app.py
+current_tenant: ContextVar[str] = ContextVar("current_tenant", default=DEFAULT_TENANT)
+
+
+
+def database_name(tenant: str) -> str:
+    if tenant == DEFAULT_TENANT:
+        return "user_balance"
+    return f"user_balance_{tenant}"
+
+
+def tenant_database(tenant: str) -> TenantDatabase:
+    handle = db.tenants.get(tenant)
+    if handle is None:
+        handle = TenantDatabase(tenant, db.client[database_name(tenant)])
+        db.tenants[tenant] = handle
+    return handle
+
+
+def get_db() -> TenantDatabase:
+    """ The database of the tenant the current request belongs to. """
+    return tenant_database(current_tenant.get())
 
 
 
-async def connect_to_mongo():
+async def connect_to_mongo(url: str = None):
     logger.info("Connecting to MongoDB...")
-    db.client = AsyncIOMotorClient(os.getenv("MONGO_DETAILS", "mongodb://localhost:27017"))
-    db.db = db.client.user_balance
+    db.client = AsyncIOMotorClient(url or os.getenv("MONGO_DETAILS", "mongodb://localhost:27017"))
+    db.tenants = {}
+    db.db = tenant_database(DEFAULT_TENANT).db
     logger.info("Connected to MongoDB")
 
 
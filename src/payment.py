@@ -1,16 +1,19 @@
 import os
 import json
 from typing import Optional
-import requests
 # from fastapi import HTTPException
 import bolt11
+import requests
 # from bson.objectid import ObjectId
 
 import logging
 logger = logging.getLogger(__name__)
 
 from src.config import TOKENS_PER_SAT #TODO: This needs to be a function that we can calculate routinely
-from src.database import db
+from src.config import ALBY_API_URL
+from src.database import get_db
+from src.ratelimit import provider_get, ProviderUnavailable
+from src.cache import read_through, invalidate
 
 
 
@@ -29,20 +32,24 @@ async def return_user_balance(username: str) -> Optional[int]:
     Returns:
         Optional[int]: The balance of the user as an integer if found, otherwise None.
 
+    NOTE: goes through the shared cache when CACHE_URL is set (see src/cache.py).
     """
-    user_collection = db.db.get_collection("users")
-    user = await user_collection.find_one({"username": username})
-    if not user:
-        logger.warning("User not found when checking a balance - user must not be registered.")
-        # raise HTTPException(status_code=404, detail="User not found")
-        return None
+    async def load() -> Optional[int]:
+        user_collection = get_db().users
+        user = await user_collection.find_one({"username": username})
+        if not user:
+            logger.warning("User not found when checking a balance - user must not be registered.")
+            # raise HTTPException(status_code=404, detail="User not found")
+            return None
+
+        balance = user.get("balance", None)
+        if balance is not None:
+            return int(balance)
 
-    balance = user.get("balance", None)
-    if balance is not None:
-        return int(balance)
+        logger.critical("User found but balance not found - this should not happen.")
+        return None # it should never reach here, but just in case...
 
-    logger.critical("User found but balance not found - this should not happen.")
-    return None # it should never reach here, but just in case...
+    return await read_through("balance", username, load)
 
 
 
@@ -56,7 +63,7 @@ async def create_invoice(username: str, amount: int = 50):
     if not payee_address:
         raise NotImplementedError("Payee address is required in your .env file!!")
 
-    url = "https://api.getalby.com/lnurl/generate-invoice"
+    url = f"{ALBY_API_URL}/lnurl/generate-invoice"
     params = {
         "ln": payee_address,
         "amount": amount * 1000,  # in millisats
@@ -65,7 +72,7 @@ async def create_invoice(username: str, amount: int = 50):
 
     logger.info(f"Creating invoice for {amount} sats")
 
-    response = requests.get(url, params=params)
+    response = await provider_get(url, params=params)
     if response.status_code == 200:
         invoice_details = response.json()['invoice']
         logger.debug("Invoice created!")
@@ -85,7 +92,7 @@ async def create_invoice(username: str, amount: int = 50):
         logger.debug(invoice)
 
         # save to the database
-        invoices_collection = db.db.get_collection("invoices")
+        invoices_collection = get_db().invoices
         await invoices_collection.insert_one(invoice)
         # NOTE: WATCH OUT! MongoDB adds a ObjectId '_id' here and it's not serializable to JSON!
         # logger.debug("AFTER WE ADDED TO THE DATABASE:"
@@ -107,13 +114,13 @@ async def create_invoice(username: str, amount: int = 50):
 
 
 async def get_pending_invoices(username: str):
-    invoices_collection = db.db.get_collection("invoices")
+    invoices_collection = get_db().invoices
     pending = await invoices_collection.find({"username": username, "status": "pending"}).to_list(length=None)
     return pending
 
 
 async def get_single_pending_invoice(username: str):
-    invoices_collection = db.db.get_collection("invoices")
+    invoices_collection = get_db().invoices
     latest_pending = await invoices_collection.find({"username": username, "status": "pending"}, sort=[("_id", -1)]).to_list(length=None)
     # latest = await invoices_collection.find_one({"username": username}, sort=[("_id", -1)])
     if latest_pending and len(latest_pending) > 0:
@@ -128,7 +135,12 @@ async def poll_pending_invoices(username: str) -> None:
     pending_invoices = await get_pending_invoices(username)
 
     for invoice in pending_invoices:
-        await credit_user_if_paid(invoice, username)
+        try:
+            await credit_user_if_paid(invoice, username)
+        except (ProviderUnavailable, requests.RequestException) as e:
+            # the invoice stays pending and is checked again on the next poll
+            logger.warning(f"Skipping invoice polling for {username}: {e}")
+            return
 
 
 
@@ -151,36 +163,35 @@ async def credit_user_if_paid(invoice: dict, username: str) -> bool:
         logger.debug("This invoice has expired.")
         # return False
         # update the invoice status
-        invoices_collection = db.db.get_collection("invoices")
+        invoices_collection = get_db().invoices
         await invoices_collection.update_one(
             {"pr": invoice['pr']},
             {"$set": {"status": "expired"}}
         )
         return
 
-    # Credit the user
-    user_collection = db.db.get_collection("users")
-    user = await user_collection.find_one({"username": username})
-
-    if not user:
-        # A new user is paying for the first time and being "registered" here
-        user = {"username": username, "balance": amount_paid}
-        await user_collection.insert_one(user)
-
-    else:
-        new_balance = user["balance"] + amount_paid
-        await user_collection.update_one(
-            {"username": username},
-            {"$set": {"balance": new_balance}}
-        )
+    # Flip the invoice to settled first and only credit the user if this call did the flip - a poll that
+    # overlaps with another one (or a retry after a failure further down) can't credit the same invoice twice
+    invoices_collection = get_db().invoices
+    flipped = await invoices_collection.find_one_and_update(
+        {"pr": invoice['pr'], "status": "pending"},
+        {"$set": {"status": "settled"}, "$currentDate": {"settled_at": True}} # server time of the write, lets reconciliation run incrementally
+    )
+    if flipped is None:
+        logger.debug("This invoice was already settled by another poll.")
+        return
 
-    # Update the invoice status
-    invoices_collection = db.db.get_collection("invoices")
-    await invoices_collection.update_one(
-        {"pr": invoice['pr']},
-        {"$set": {"status": "settled"}}
+    # Credit the user - a new user paying for the first time is "registered" here by the upsert
+    user_collection = get_db().users
+    await user_collection.update_one(
+        {"username": username},
+        {"$inc": {"balance": amount_paid}},
+        upsert=True
     )
 
+    # cache maintenance goes last and never raises, so it can't come between the two ledger writes
+    await invalidate("balance", username)
+
     logger.debug("This invoice has been paid! 💰")
     # return True
 
@@ -205,7 +216,7 @@ async def check_invoice_for_payment_or_expiry(invoice: dict) -> Optional[int]:
 
     verify_url = invoice['verify']
 
-    response = requests.get(verify_url)
+    response = await provider_get(verify_url)
     if response.status_code == 200:
         status = response.json().get('status')
         settled = response.json().get('settled', False)
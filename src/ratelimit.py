@@ -0,0 +1,233 @@
+import time
+import asyncio
+from typing import Callable
+from contextlib import asynccontextmanager
+
+import requests
+from fastapi import HTTPException, status
+from pymongo import ReturnDocument
+
+from src.logger import logger
+from src.database import get_db, current_tenant
+from src.config import (
+    RATE_LIMIT_PER_MINUTE,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_BACKEND,
+    PROVIDER_MAX_CONCURRENCY,
+    PROVIDER_ACQUIRE_TIMEOUT,
+    PROVIDER_REQUEST_TIMEOUT,
+    PROVIDER_FAILURE_THRESHOLD,
+    PROVIDER_RESET_SECONDS,
+)
+
+
+
+class ProviderUnavailable(Exception):
+    """ Raised when a call to the payment provider is refused locally (breaker open or no free slot). """
+
+
+
+class MemoryRateLimiter:
+    """
+        Token buckets kept in this process. Each key starts with `burst` tokens and refills at `rate` tokens per second.
+
+        A bucket idle for `burst / rate` seconds is full again and carries no state, so it is dropped by a sweep that
+        runs at most once per that interval. `clock` can be swapped for a fake one.
+
+        NOTE: with several uvicorn workers every worker has its own buckets, so the effective limit is multiplied by the worker count.
+    """
+    def __init__(self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.idle_seconds = burst / rate
+        self.buckets = {} # key -> (tokens, last_refill)
+        self.swept_at = clock()
+
+    async def allow(self, key: str) -> bool:
+        now = self.clock()
+        if now - self.swept_at >= self.idle_seconds:
+            self.sweep(now)
+
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        self.buckets[key] = (tokens, now)
+        return allowed
+
+    def sweep(self, now: float):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < self.idle_seconds}
+        self.swept_at = now
+
+
+
+class MongoRateLimiter:
+    """
+        Token buckets stored in each tenant's `rate_limits` collection so that the limit holds across workers.
+
+        Each check is a single atomic `find_one_and_update` with an update pipeline, timed with the server clock ($$NOW).
+        Idle buckets are removed by a TTL index.
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.indexed = set() # tenants whose TTL index has been created
+
+    async def allow(self, key: str) -> bool:
+        tenant = get_db()
+        rate_limits = tenant.db.get_collection("rate_limits")
+
+        if tenant.name not in self.indexed:
+            # a bucket idle for long enough to refill completely carries no state
+            await rate_limits.create_index("updated", expireAfterSeconds=int(self.burst / self.rate) + 60)
+            self.indexed.add(tenant.name)
+
+        elapsed = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$updated", "$$NOW"]}]}, 1000]}
+        bucket = await rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {
+                    "tokens": {"$min": [self.burst, {"$add": [{"$ifNull": ["$tokens", self.burst]}, {"$multiply": [elapsed, self.rate]}]}]},
+                    "updated": "$$NOW",
+                }},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return bucket["allowed"]
+
+
+
+class CircuitBreaker:
+    """
+        Stops calling the provider after `failure_threshold` consecutive failures.
+
+        After `reset_seconds` a single trial call is let through (half-open); success closes the breaker, failure opens it again.
+    """
+    def __init__(self, failure_threshold: int, reset_seconds: float, clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+
+        if self.trial_in_flight or self.clock() - self.opened_at < self.reset_seconds:
+            return False
+
+        self.trial_in_flight = True
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Payment provider recovered - closing circuit breaker")
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.critical(f"Payment provider failed {self.failures} times in a row - opening circuit breaker")
+            self.opened_at = self.clock()
+
+
+
+def make_rate_limiter(backend: str = RATE_LIMIT_BACKEND, per_minute: int = RATE_LIMIT_PER_MINUTE, burst: int = RATE_LIMIT_BURST):
+    # Retry-After and the idle expiry both divide by the rate - fail at startup rather than on the first 429
+    if per_minute <= 0:
+        raise ValueError(f"RATE_LIMIT_PER_MINUTE must be at least 1, got {per_minute}")
+    if burst < 1:
+        raise ValueError(f"RATE_LIMIT_BURST must be at least 1, got {burst}")
+
+    rate = per_minute / 60
+    if backend == "mongo":
+        return MongoRateLimiter(rate, burst)
+    if backend == "memory":
+        return MemoryRateLimiter(rate, burst)
+    raise NotImplementedError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+
+
+rate_limiter = make_rate_limiter()
+provider_breaker = CircuitBreaker(PROVIDER_FAILURE_THRESHOLD, PROVIDER_RESET_SECONDS)
+provider_slots = asyncio.Semaphore(PROVIDER_MAX_CONCURRENCY)
+
+
+
+async def enforce_rate_limit(username: str, route: str) -> None:
+    """
+        Raises a 429 if `username` has used up its token bucket for `route`.
+
+        This is checked before any database or provider work so that a looping client is turned away cheaply.
+    """
+    if await rate_limiter.allow(f"{current_tenant.get()}:{route}:{username}"):
+        return
+
+    logger.warning(f"Rate limit hit for {username} on {route}")
+    raise HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests",
+        headers={"Retry-After": str(max(1, round(60 / RATE_LIMIT_PER_MINUTE)))},
+    )
+
+
+
+@asynccontextmanager
+async def provider_call():
+    """
+        Admission control for a single call to the payment provider.
+
+        Refuses with ProviderUnavailable when the circuit breaker is open or when no concurrency slot frees up within
+        PROVIDER_ACQUIRE_TIMEOUT. An exception inside the block counts as a failure.
+    """
+    if not provider_breaker.allow():
+        raise ProviderUnavailable("circuit breaker is open")
+
+    try:
+        await asyncio.wait_for(provider_slots.acquire(), timeout=PROVIDER_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        # don't leave a half-open trial hanging if we never got to make the call
+        provider_breaker.trial_in_flight = False
+        raise ProviderUnavailable("too many concurrent provider calls")
+
+    try:
+        yield
+    except Exception:
+        provider_breaker.record_failure()
+        raise
+    finally:
+        # a cancelled call (client gone, timeout) is neither a success nor a failure, but it must not leave the
+        # half-open trial marked as in flight or the breaker never lets another call through
+        provider_breaker.trial_in_flight = False
+        provider_slots.release()
+
+
+
+async def provider_get(url: str, params: dict = None) -> requests.Response:
+    """
+        GET against the payment provider, behind the concurrency cap and circuit breaker.
+
+        The blocking `requests` call runs in a worker thread so that slow provider responses don't stall the event loop.
+        A 429 or 5xx from the provider counts as a failure for the breaker.
+    """
+    async with provider_call():
+        response = await asyncio.to_thread(requests.get, url, params=params, timeout=PROVIDER_REQUEST_TIMEOUT)
+
+        if response.status_code == 429 or response.status_code >= 500:
+            provider_breaker.record_failure()
+        else:
+            provider_breaker.record_success()
+
+        return response
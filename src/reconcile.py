@@ -0,0 +1,299 @@
+"""
+Balance reconciliation: checks every user's `balance` against settled invoices minus recorded usage.
+
+    python -m src.reconcile                       # incremental from the last checkpoint (full on the first run)
+    python -m src.reconcile --full --out discrepancies.ndjson
+    python -m src.reconcile --database reconcile_bench seed --users 1000000
+
+Expected balances are built server-side by one aggregation over `invoices` and `transactions` ($unionWith) and
+$merge'd into `ledger_totals`, one running total per user. An incremental run only folds in invoices settled and
+usage recorded since the checkpoint, and only re-checks the users it touched; use --full to rebuild everything
+and to also catch balances changed by hand (e.g. from the admin panel).
+
+Windows are cut on write time, not on the `timestamp` the API puts in a usage record: invoices by `settled_at`
+(stamped by the server with $currentDate) and transactions by their ObjectId, which the driver generates right at
+insert. Only writes that land more than --lag seconds after that (or a worker clock that far off) can slip behind
+the checkpoint - a --full run is always authoritative.
+
+Discrepancies are streamed out as NDJSON: {username, balance, expected, delta}. A username with ledger entries but
+no user document is reported with `balance: null`.
+"""
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+
+import dotenv
+from bson import ObjectId
+
+from src.logger import setup_logging, logger
+from src.database import db, connect_to_mongo, close_mongo_connection, tenant_database
+from src.bulk import Throughput, open_output, write_doc, close_stream
+
+
+CHECKPOINT_ID = "checkpoint"
+
+# balances set through the admin panel are floats
+TOLERANCE = 1e-6
+
+
+
+async def ensure_indexes():
+    await db.db.get_collection("invoices").create_index([("status", 1), ("settled_at", 1)])
+    await db.db.get_collection("users").create_index("username")
+    await db.db.get_collection("ledger_totals").create_index("updated_at")
+
+
+
+def ledger_pipeline(since, until: datetime, full: bool) -> list:
+    """
+        Per-user sum of settled invoice amounts minus tokens used, for the window [since, until).
+
+        `since` and `until` are whole seconds, the resolution of an ObjectId's timestamp, so consecutive windows
+        neither overlap nor leave gaps.
+    """
+    if full:
+        # invoices settled before `settled_at` was recorded only show up in full runs
+        settled_window = {"$or": [{"settled_at": {"$lt": until}}, {"settled_at": {"$exists": False}}]}
+        tx_window = {"_id": {"$lt": ObjectId.from_datetime(until)}}
+        when_matched = "replace"
+    else:
+        settled_window = {"settled_at": {"$gte": since, "$lt": until}}
+        tx_window = {"_id": {"$gte": ObjectId.from_datetime(since), "$lt": ObjectId.from_datetime(until)}}
+        when_matched = [{"$set": {"total": {"$add": ["$total", "$$new.total"]}, "updated_at": "$$new.updated_at"}}]
+
+    return [
+        {"$match": {"status": "settled", **settled_window}},
+        {"$project": {"_id": False, "username": True, "delta": "$amount"}},
+        {"$unionWith": {
+            "coll": "transactions",
+            "pipeline": [
+                {"$match": tx_window},
+                {"$project": {"_id": False, "username": True, "delta": {"$subtract": [0, "$tokens_used"]}}},
+            ],
+        }},
+        {"$group": {"_id": "$username", "total": {"$sum": "$delta"}}},
+        {"$set": {"updated_at": until}},
+        {"$merge": {"into": "ledger_totals", "on": "_id", "whenMatched": when_matched, "whenNotMatched": "insert"}},
+    ]
+
+
+
+def discrepancy_stage() -> list:
+    return [
+        {"$set": {"delta": {"$subtract": [{"$ifNull": ["$balance", 0]}, "$expected"]}}},
+        {"$match": {"$expr": {"$gt": [{"$abs": "$delta"}, TOLERANCE]}}},
+    ]
+
+
+def full_discrepancies_pipeline() -> list:
+    """ Every user, including users with a balance but no ledger entries at all. """
+    return [
+        {"$lookup": {"from": "ledger_totals", "localField": "username", "foreignField": "_id", "as": "ledger"}},
+        {"$project": {
+            "_id": False,
+            "username": True,
+            "balance": True,
+            "expected": {"$ifNull": [{"$first": "$ledger.total"}, 0]},
+        }},
+        *discrepancy_stage(),
+    ]
+
+
+def orphan_ledger_pipeline() -> list:
+    """ Ledger totals for usernames that have no user document at all - the other half of a full run. """
+    return [
+        {"$lookup": {"from": "users", "localField": "_id", "foreignField": "username", "as": "user"}},
+        {"$match": {"user": {"$size": 0}}},
+        {"$project": {"_id": False, "username": "$_id", "balance": {"$literal": None}, "expected": "$total"}},
+        *discrepancy_stage(),
+    ]
+
+
+def touched_discrepancies_pipeline(until: datetime) -> list:
+    """ Only the users whose ledger total changed in this run. """
+    return [
+        {"$match": {"updated_at": until}},
+        {"$lookup": {"from": "users", "localField": "_id", "foreignField": "username", "as": "user"}},
+        {"$project": {
+            "_id": False,
+            "username": "$_id",
+            "balance": {"$first": "$user.balance"},
+            "expected": "$total",
+        }},
+        *discrepancy_stage(),
+    ]
+
+
+
+async def reconcile(full: bool, out_path: str, batch_size: int, lag: float):
+    """
+        Brings `ledger_totals` up to `now - lag` and streams out the users whose balance doesn't match.
+
+        A full run checks every user and then every ledger total without a user document (reported with a null balance).
+
+        The lag leaves time for writes from `deduct_balance` / `credit_user_if_paid` that are already stamped to land.
+        A balance that moves while the job runs can still show up as a transient discrepancy.
+    """
+    await ensure_indexes()
+
+    reconciliation = db.db.get_collection("reconciliation")
+    checkpoint = await reconciliation.find_one({"_id": CHECKPOINT_ID})
+
+    if checkpoint is None:
+        full = True
+    elif checkpoint.get("in_progress"):
+        logger.warning("The previous run did not finish - ledger totals may be partly applied, rebuilding from scratch")
+        full = True
+
+    since = None if full else checkpoint["until"]
+    until = (datetime.utcnow() - timedelta(seconds=lag)).replace(microsecond=0)
+
+    logger.info(f"Reconciling {'everything' if full else f'from {since}'} up to {until}")
+
+    await reconciliation.update_one({"_id": CHECKPOINT_ID}, {"$set": {"in_progress": True}}, upsert=True)
+
+    started = time.perf_counter()
+    if full:
+        await db.db.get_collection("ledger_totals").delete_many({})
+    await db.db.get_collection("invoices").aggregate(ledger_pipeline(since, until, full), allowDiskUse=True).to_list(length=None)
+    logger.info(f"Ledger totals updated in {time.perf_counter() - started:.2f}s")
+
+    await reconciliation.update_one(
+        {"_id": CHECKPOINT_ID},
+        {"$set": {"until": until, "in_progress": False, **({"full_at": until} if full else {})}},
+    )
+
+    if full:
+        passes = [("users", full_discrepancies_pipeline()), ("ledger_totals", orphan_ledger_pipeline())]
+    else:
+        passes = [("ledger_totals", touched_discrepancies_pipeline(until))]
+
+    started = time.perf_counter()
+    found = Throughput("discrepancies")
+    out = open_output(out_path, "ndjson")
+    try:
+        for collection, pipeline in passes:
+            cursor = db.db.get_collection(collection).aggregate(pipeline, batchSize=batch_size, allowDiskUse=True)
+            while batch := await cursor.to_list(length=batch_size):
+                for doc in batch:
+                    write_doc(out, doc, "ndjson")
+                out.flush()
+                found.add(len(batch))
+    finally:
+        close_stream(out)
+
+    logger.info(f"Found {found.count:,} discrepancies in {time.perf_counter() - started:.2f}s")
+
+
+
+async def seed(users: int, invoices_per_user: int, tx_per_user: int, drift: float, batch_size: int):
+    """
+        Fills the selected database with synthetic users, invoices and transactions for benchmarking.
+
+        A `drift` fraction of users get a balance that is off by one so the run has something to find.
+    """
+    if db.db.name.startswith("user_balance"):
+        raise SystemExit("Refusing to seed a production (tenant) database - pass --database")
+
+    progress = Throughput("seed users")
+    now = datetime.utcnow()
+    user_batch, invoice_batch, tx_batch = [], [], []
+
+    async def flush():
+        if user_batch:
+            await db.db.get_collection("users").insert_many(user_batch, ordered=False)
+        if invoice_batch:
+            await db.db.get_collection("invoices").insert_many(invoice_batch, ordered=False)
+        if tx_batch:
+            await db.db.get_collection("transactions").insert_many(tx_batch, ordered=False)
+        progress.add(len(user_batch))
+        user_batch.clear()
+        invoice_batch.clear()
+        tx_batch.clear()
+
+    for i in range(users):
+        username = f"user{i:09d}"
+        balance = 0
+
+        for n in range(invoices_per_user):
+            amount = random.choice([50, 100, 500])
+            balance += amount
+            invoice_batch.append({
+                "username": username,
+                "status": "settled",
+                "pr": f"lnbcsynthetic{i}x{n}",
+                "verify": "",
+                "amount": amount,
+                "settled_at": now - timedelta(minutes=random.randint(1, 60 * 24 * 30)),
+            })
+
+        for n in range(tx_per_user):
+            tokens_used = random.randint(1, 20)
+            balance -= tokens_used
+            tx_batch.append({
+                "username": username,
+                "thread_id": f"thread{n % 5}",
+                "tokens_used": tokens_used,
+                "timestamp": now - timedelta(minutes=random.randint(1, 60 * 24 * 30)),
+            })
+
+        if random.random() < drift:
+            balance += 1
+
+        user_batch.append({"username": username, "balance": balance})
+
+        if len(user_batch) >= batch_size:
+            await flush()
+
+    await flush()
+    progress.done()
+
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m src.reconcile", description="Check user balances against the invoice / usage ledger")
+    parser.add_argument("--tenant", default=None, help="work on this tenant's database instead of the default one")
+    parser.add_argument("--database", default=None, help="database to use instead of user_balance")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--full", action="store_true", help="rebuild all ledger totals and check every user")
+    parser.add_argument("--out", default="-", help="where to write discrepancies as NDJSON (default: stdout)")
+    parser.add_argument("--lag", type=float, default=5, help="ignore the last N seconds of activity (default: 5)")
+    sub = parser.add_subparsers(dest="command")
+
+    seed_parser = sub.add_parser("seed", help="fill --database with synthetic data for benchmarking")
+    seed_parser.add_argument("--users", type=int, default=100_000)
+    seed_parser.add_argument("--invoices-per-user", type=int, default=3)
+    seed_parser.add_argument("--tx-per-user", type=int, default=20)
+    seed_parser.add_argument("--drift", type=float, default=0.01, help="fraction of users given a wrong balance")
+
+    return parser.parse_args(argv)
+
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+
+    await connect_to_mongo()
+    if args.tenant:
+        db.db = tenant_database(args.tenant).db
+    if args.database:
+        db.db = db.client[args.database]
+
+    try:
+        if args.command == "seed":
+            await seed(args.users, args.invoices_per_user, args.tx_per_user, args.drift, args.batch_size)
+        else:
+            started = time.perf_counter()
+            await reconcile(args.full, args.out, args.batch_size, args.lag)
+            logger.info(f"Reconciliation finished in {time.perf_counter() - started:.2f}s")
+    finally:
+        await close_mongo_connection()
+
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    setup_logging()
+    asyncio.run(main())
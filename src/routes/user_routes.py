@@ -1,10 +1,13 @@
+import requests
 from fastapi import APIRouter, HTTPException, status
 from datetime import datetime
 
 from src.logger import logger
-from src.database import db
+from src.database import get_db
 from src.models import UsageDeducation, UsageRecord, InvoiceRequest, UsageRequest
 from src.payment import return_user_balance, create_invoice, poll_pending_invoices, get_single_pending_invoice
+from src.ratelimit import enforce_rate_limit, ProviderUnavailable
+from src.cache import read_through, invalidate
 
 router = APIRouter()
 
@@ -12,6 +15,7 @@ router = APIRouter()
 @router.get("/balance/")
 async def get_balance(username: str):
     logger.debug(f">>> /balance/\tRequest: {username}")
+    await enforce_rate_limit(username, "balance")
 
     # Check for pending invoices and credit user if paid
     await poll_pending_invoices(username)
@@ -29,6 +33,7 @@ async def get_invoice(request: InvoiceRequest):
 
     username: str = request.username
     # tokens_requested: int = request.tokens_requested
+    await enforce_rate_limit(username, "invoice")
 
     # This can be cleaned up... if poll_pending_invoices returns a pending invoice, return that.
     # It would need to sort by the most recent invoice, though... or maybe not? becuase we fixed the bug?
@@ -40,7 +45,11 @@ async def get_invoice(request: InvoiceRequest):
         return pending_invoice
     else:
         logger.debug(f">>> /invoice/ creating new invoice")
-        return await create_invoice(username=username)
+        try:
+            return await create_invoice(username=username)
+        except (ProviderUnavailable, requests.RequestException) as e:
+            logger.error(f"Could not create invoice: {e}")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Payment provider unavailable, try again later")
 
 
 
@@ -57,7 +66,7 @@ async def deduct_balance(request: UsageDeducation):
     thread_id = request.thread_id
     tokens_used = request.tokens_used
 
-    user_collection = db.db.get_collection("users")
+    user_collection = get_db().users
     user = await user_collection.find_one({"username": username})
 
     if not user:
@@ -73,7 +82,7 @@ async def deduct_balance(request: UsageDeducation):
     )
 
     # Optional: log the transaction in a transactions collection
-    tx_collection = db.db.get_collection("transactions")
+    tx_collection = get_db().transactions
     new_tx = UsageRecord(
         username=username,
         thread_id=thread_id,
@@ -82,6 +91,10 @@ async def deduct_balance(request: UsageDeducation):
     )
     await tx_collection.insert_one(new_tx.dict())
 
+    # only after both MongoDB writes; these never raise
+    await invalidate("balance", username)
+    await invalidate("usage", f"{username}:{thread_id}")
+
     return {"username": username, "new_balance": new_balance}
 
 
@@ -94,11 +107,13 @@ async def get_transactions(request: UsageRequest):
     thread_id = request.thread_id
 
 
-    tx_collection = db.db.get_collection("transactions")
-    transactions = await tx_collection.find({"username": username, "thread_id": thread_id}).to_list(length=None)
-    logger.debug(f"Transactions: {transactions}")
+    async def load() -> int:
+        tx_collection = get_db().transactions
+        transactions = await tx_collection.find({"username": username, "thread_id": thread_id}).to_list(length=None)
+        logger.debug(f"Transactions: {transactions}")
 
-    thread_usage = sum(t['tokens_used'] for t in transactions)
+        thread_usage = sum(t['tokens_used'] for t in transactions)
+        # return transactions
+        return int(thread_usage)
 
-    # return transactions
-    return int(thread_usage)
\ No newline at end of file
+    return await read_through("usage", f"{username}:{thread_id}", load)
\ No newline at end of file
@@ -0,0 +1,227 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+import src.cache
+import src.payment
+from src.cache import MemoryCache, read_through, invalidate
+from src.database import current_tenant
+
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class BrokenCache:
+    """ A cache whose every command fails, like Redis during an outage. """
+    async def get(self, key):
+        raise ConnectionError("cache down")
+
+    async def set(self, key, value, ttl):
+        raise ConnectionError("cache down")
+
+    async def incr(self, key):
+        raise ConnectionError("cache down")
+
+
+class Store:
+    """ Stands in for MongoDB: a value plus a count of the loads that reached it. """
+    def __init__(self, value):
+        self.value = value
+        self.loads = 0
+
+    async def load(self):
+        self.loads += 1
+        return self.value
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def cache(clock):
+    memory = MemoryCache(clock=clock)
+    with patch.object(src.cache, "cache", memory):
+        yield memory
+
+
+
+def test_read_through_caches_until_ttl(cache, clock):
+    store = Store(100)
+
+    async def scenario():
+        assert await read_through("balance", "alice", store.load) == 100
+        store.value = 50 # changed behind the cache's back, e.g. from the admin panel
+        assert await read_through("balance", "alice", store.load) == 100
+        clock.now += src.cache.CACHE_TTL_SECONDS
+        assert await read_through("balance", "alice", store.load) == 50
+
+    asyncio.run(scenario())
+    assert store.loads == 2
+
+
+def test_none_is_not_cached(cache):
+    store = Store(None)
+
+    async def scenario():
+        assert await read_through("balance", "nobody", store.load) is None
+        assert await read_through("balance", "nobody", store.load) is None
+
+    asyncio.run(scenario())
+    assert store.loads == 2
+
+
+def test_invalidate_after_write_reloads(cache):
+    store = Store(100)
+
+    async def scenario():
+        await read_through("balance", "alice", store.load)
+        store.value = 90
+        await invalidate("balance", "alice")
+        assert await read_through("balance", "alice", store.load) == 90
+
+    asyncio.run(scenario())
+
+
+def test_slow_reader_cannot_park_a_stale_value(cache):
+    store = Store(100)
+
+    async def scenario():
+        loaded = asyncio.Event()
+        written = asyncio.Event()
+
+        async def slow_load():
+            value = await store.load() # reads 100 ...
+            loaded.set()
+            await written.wait() # ... while a writer lands 90 and invalidates
+            return value
+
+        async def writer():
+            await loaded.wait()
+            store.value = 90
+            await invalidate("balance", "alice")
+            written.set()
+
+        stale, _ = await asyncio.gather(read_through("balance", "alice", slow_load), writer())
+        assert stale == 100 # the in-flight read may still return what it loaded ...
+        assert await read_through("balance", "alice", store.load) == 90 # ... but it isn't what gets served next
+
+    asyncio.run(scenario())
+
+
+def test_writers_finishing_out_of_order_leave_the_latest_value(cache):
+    store = Store(100)
+
+    async def scenario():
+        await read_through("balance", "alice", store.load)
+        # A lands 90 in MongoDB, then B lands 80 - but B invalidates before A does
+        store.value = 90
+        store.value = 80
+        await invalidate("balance", "alice") # B
+        await invalidate("balance", "alice") # A
+        assert await read_through("balance", "alice", store.load) == 80
+
+    asyncio.run(scenario())
+
+
+def test_version_survives_long_idle_periods(cache, clock):
+    store = Store(100)
+
+    async def scenario():
+        store.value = 90
+        await invalidate("balance", "alice")
+        clock.now = 599
+        assert await read_through("balance", "alice", store.load) == 90
+        # long after the write - a counter that expired here would restart on the version 90 is parked under
+        clock.now = 601
+        store.value = 80
+        await invalidate("balance", "alice")
+        assert await read_through("balance", "alice", store.load) == 80
+        clock.now = 100_000
+        store.value = 70
+        await invalidate("balance", "alice")
+        assert await read_through("balance", "alice", store.load) == 70
+
+    asyncio.run(scenario())
+
+
+def test_keys_are_scoped_per_tenant(cache):
+    alpha, beta = Store(1), Store(2)
+
+    async def read(tenant, store):
+        current_tenant.set(tenant)
+        return await read_through("balance", "alice", store.load)
+
+    async def scenario():
+        assert await asyncio.create_task(read("alpha", alpha)) == 1
+        assert await asyncio.create_task(read("beta", beta)) == 2
+
+    asyncio.run(scenario())
+
+
+def test_cache_outage_falls_back_to_mongo():
+    store = Store(100)
+
+    async def scenario():
+        assert await read_through("balance", "alice", store.load) == 100
+        await invalidate("balance", "alice") # logged, not raised
+
+    with patch.object(src.cache, "cache", BrokenCache()):
+        asyncio.run(scenario())
+
+
+
+class FakeCollection:
+    """ Just enough of a motor collection for credit_user_if_paid. """
+    def __init__(self, docs):
+        self.docs = docs
+
+    def _match(self, query):
+        return next((d for d in self.docs if all(d.get(k) == v for k, v in query.items())), None)
+
+    async def find_one_and_update(self, query, update):
+        doc = self._match(query)
+        if doc is not None:
+            before = dict(doc)
+            doc.update(update.get("$set", {}))
+            return before
+        return None
+
+    async def update_one(self, query, update, upsert=False):
+        doc = self._match(query)
+        if doc is None and upsert:
+            doc = dict(query)
+            self.docs.append(doc)
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+
+
+def test_cache_outage_does_not_credit_an_invoice_twice():
+    invoices = FakeCollection([{"pr": "lnbc1", "status": "pending", "username": "alice"}])
+    users = FakeCollection([{"username": "alice", "balance": 0}])
+    tenant = SimpleNamespace(invoices=invoices, users=users)
+
+    async def paid(invoice):
+        return 100
+
+    async def scenario():
+        for _ in range(3):
+            for invoice in [d for d in invoices.docs if d["status"] == "pending"]:
+                await src.payment.credit_user_if_paid(invoice, "alice")
+
+    with patch.object(src.cache, "cache", BrokenCache()), \
+            patch.object(src.payment, "get_db", lambda: tenant), \
+            patch.object(src.payment, "check_invoice_for_payment_or_expiry", paid):
+        asyncio.run(scenario())
+
+    assert invoices.docs[0]["status"] == "settled"
+    assert users.docs[0]["balance"] == 100
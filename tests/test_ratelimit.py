@@ -0,0 +1,166 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+import src.ratelimit
+from src.ratelimit import MemoryRateLimiter, CircuitBreaker, ProviderUnavailable, make_rate_limiter, provider_call
+
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30, clock=clock)
+    with patch.object(src.ratelimit, "provider_breaker", breaker):
+        yield breaker
+
+
+@pytest.fixture
+def slots():
+    semaphore = asyncio.Semaphore(1)
+    with patch.object(src.ratelimit, "provider_slots", semaphore):
+        yield semaphore
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+
+
+
+def test_bucket_rejects_when_empty_and_refills(clock):
+    limiter = MemoryRateLimiter(rate=1, burst=3, clock=clock)
+
+    async def scenario():
+        assert [await limiter.allow("alice") for _ in range(4)] == [True, True, True, False]
+        assert await limiter.allow("bob") # buckets are per key
+        clock.now += 1
+        assert await limiter.allow("alice")
+        assert not await limiter.allow("alice")
+        clock.now += 10 # refills up to `burst`, not beyond
+        assert [await limiter.allow("alice") for _ in range(4)] == [True, True, True, False]
+
+    asyncio.run(scenario())
+
+
+def test_idle_buckets_are_swept(clock):
+    limiter = MemoryRateLimiter(rate=1, burst=3, clock=clock)
+
+    async def scenario():
+        for n in range(1000):
+            await limiter.allow(f"user{n}")
+        clock.now += 1
+        await limiter.allow("alice")
+        assert len(limiter.buckets) == 1001 # nothing idle long enough yet
+        clock.now += 3
+        await limiter.allow("alice")
+        assert set(limiter.buckets) == {"alice"}
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("per_minute, burst", [(0, 10), (-1, 10), (30, 0)])
+def test_invalid_rate_is_refused(per_minute, burst):
+    with pytest.raises(ValueError):
+        make_rate_limiter("memory", per_minute, burst)
+
+
+
+def test_breaker_opens_after_threshold(breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_trial_through_then_closes_on_success(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    assert not breaker.allow() # only one trial while it's in flight
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_breaker_reopens_when_the_trial_fails(breaker, clock):
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow() # the reset timer restarted with the failed trial
+    clock.now += 1
+    assert breaker.allow()
+
+
+
+def test_cancelled_trial_releases_breaker_and_slot(breaker, clock, slots):
+    open_breaker(breaker)
+    clock.now += 30
+
+    async def scenario():
+        entered = asyncio.Event()
+
+        async def call():
+            async with provider_call():
+                entered.set()
+                await asyncio.Event().wait() # provider never answers
+
+        task = asyncio.create_task(call())
+        await entered.wait()
+        assert breaker.trial_in_flight
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+        assert not breaker.trial_in_flight
+        assert not slots.locked()
+        assert breaker.allow() # the next caller gets the trial
+
+    asyncio.run(scenario())
+
+
+def test_slot_timeout_releases_trial(breaker, clock, slots):
+    open_breaker(breaker)
+    clock.now += 30
+
+    async def scenario():
+        await slots.acquire() # every slot is busy
+        with pytest.raises(ProviderUnavailable):
+            async with provider_call():
+                pass
+        assert not breaker.trial_in_flight
+        assert breaker.allow()
+
+    with patch.object(src.ratelimit, "PROVIDER_ACQUIRE_TIMEOUT", 0.01):
+        asyncio.run(scenario())
+
+
+def test_exception_in_call_counts_as_failure(breaker, slots):
+    async def scenario():
+        for _ in range(breaker.failure_threshold):
+            with pytest.raises(ConnectionError):
+                async with provider_call():
+                    raise ConnectionError("provider down")
+        with pytest.raises(ProviderUnavailable):
+            async with provider_call():
+                pass
+        assert not slots.locked()
+
+    asyncio.run(scenario())